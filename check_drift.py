@@ -0,0 +1,100 @@
+"""Проверка дрейфа косинусного сходства после INT8-квантизации CLIP.
+
+Запуск: python check_drift.py ПАПКА_С_ФОТО [текстовый запрос ...]
+
+Эталон - исходная fp32-модель. Для каждого INT8-бэкенда (torch dynamic quantization и,
+если собраны, ONNX-модели из export_onnx.py) считается относительное изменение сходства
+текст-изображение. Отдельно проверяется смешанный случай из бота: старые fp32-эмбеддинги
+вещей против INT8-эмбеддинга запроса. Код возврата 1, если дрейф больше MAX_DRIFT.
+"""
+import os
+import sys
+import copy
+import numpy as np
+from PIL import Image
+import torch
+from sentence_transformers import SentenceTransformer
+from export_onnx import ONNX_DIR, IMAGE_ONNX_PATH, TEXT_ONNX_PATH
+
+MAX_DRIFT = 0.02  # Допустимое относительное изменение сходства
+DEFAULT_QUERIES = ["вечерний образ", "повседневная одежда", "спортивный костюм",
+                   "a red dress", "blue jeans", "a winter coat"]
+
+def load_images(folder):
+    """Читает фото так же, как бот: уменьшенное декодирование и 224x224"""
+    imgs = []
+    for name in sorted(os.listdir(folder)):
+        if not name.lower().endswith((".jpg", ".jpeg", ".png")):
+            continue
+        img = Image.open(os.path.join(folder, name))
+        img.draft('RGB', (224, 224))
+        imgs.append(img.convert('RGB').resize((224, 224), Image.BICUBIC))
+    return imgs
+
+def normalize_rows(emb):
+    emb = np.asarray(emb, dtype=np.float32)
+    return emb / (np.linalg.norm(emb, axis=1, keepdims=True) + 1e-12)
+
+def encode_torch(model, imgs, texts):
+    with torch.inference_mode():
+        return (normalize_rows(model.encode(imgs, convert_to_numpy=True)),
+                normalize_rows(model.encode(texts, convert_to_numpy=True)))
+
+def encode_onnx(imgs, texts):
+    import onnxruntime as ort
+    from transformers import CLIPProcessor
+
+    processor = CLIPProcessor.from_pretrained(ONNX_DIR)
+    image_session = ort.InferenceSession(IMAGE_ONNX_PATH, providers=["CPUExecutionProvider"])
+    text_session = ort.InferenceSession(TEXT_ONNX_PATH, providers=["CPUExecutionProvider"])
+    pixel_values = processor(images=imgs, return_tensors='np')["pixel_values"].astype(np.float32)
+    tokens = processor.tokenizer(texts, padding=True, truncation=True, max_length=77, return_tensors='np')
+    img_emb = image_session.run(None, {"pixel_values": pixel_values})[0]
+    text_emb = text_session.run(None, {
+        "input_ids": tokens["input_ids"].astype(np.int64),
+        "attention_mask": tokens["attention_mask"].astype(np.int64),
+    })[0]
+    return normalize_rows(img_emb), normalize_rows(text_emb)
+
+def relative_drift(sims, ref):
+    return float(np.max(np.abs(sims - ref) / (np.abs(ref) + 1e-6)))
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return 2
+    imgs = load_images(sys.argv[1])
+    texts = sys.argv[2:] or DEFAULT_QUERIES
+    if not imgs:
+        print(f"В {sys.argv[1]} нет фото")
+        return 2
+
+    model = SentenceTransformer('clip-ViT-B-32', device='cpu').eval()
+    ref_img, ref_text = encode_torch(model, imgs, texts)
+    ref_sims = ref_text @ ref_img.T
+
+    backends = {}
+    quantized = copy.deepcopy(model)
+    quantized[0].model = torch.ao.quantization.quantize_dynamic(quantized[0].model, {torch.nn.Linear}, dtype=torch.qint8)
+    backends["torch-int8"] = encode_torch(quantized, imgs, texts)
+    if os.path.exists(IMAGE_ONNX_PATH) and os.path.exists(TEXT_ONNX_PATH):
+        backends["onnx-int8"] = encode_onnx(imgs, texts)
+    else:
+        print("ONNX-модели не найдены, onnx-int8 пропущен (python export_onnx.py)")
+
+    failed = False
+    print(f"Фото: {len(imgs)}, запросов: {len(texts)}, порог: {MAX_DRIFT:.0%}")
+    for name, (img_emb, text_emb) in backends.items():
+        emb_cos = min(float(np.min(np.sum(img_emb * ref_img, axis=1))),
+                      float(np.min(np.sum(text_emb * ref_text, axis=1))))
+        drift = relative_drift(text_emb @ img_emb.T, ref_sims)
+        # Как в боте: вещи закодированы fp32-моделью, запрос - INT8
+        mixed_drift = relative_drift(text_emb @ ref_img.T, ref_sims)
+        ok = drift <= MAX_DRIFT and mixed_drift <= MAX_DRIFT
+        failed |= not ok
+        print(f"{name}: мин. косинус к fp32 {emb_cos:.4f}, дрейф сходства {drift:.2%}, "
+              f"смешанный дрейф {mixed_drift:.2%} - {'OK' if ok else 'ПРЕВЫШЕН'}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""Сборка INT8 ONNX-моделей CLIP для бота.
+
+Запускается отдельно (например, в команде сборки): python export_onnx.py
+Бот при старте только открывает готовые файлы из ONNX_DIR и не экспортирует модели сам.
+"""
+import os
+import logging
+
+ONNX_DIR = "onnx_models"
+IMAGE_ONNX_PATH = os.path.join(ONNX_DIR, "clip_image_int8.onnx")
+TEXT_ONNX_PATH = os.path.join(ONNX_DIR, "clip_text_int8.onnx")
+
+logger = logging.getLogger(__name__)
+
+def export_onnx(module, args, input_names, path):
+    """Экспортирует модуль в ONNX и квантизует веса в INT8; готовый файл появляется атомарно"""
+    import torch
+    from onnxruntime.quantization import quantize_dynamic as ort_quantize_dynamic, QuantType
+
+    fp32_path = path.replace("_int8", "")
+    tmp_path = path + ".tmp"
+    dynamic_axes = {name: {0: "batch", 1: "seq"} if name != "pixel_values" else {0: "batch"} for name in input_names}
+    dynamic_axes["embeds"] = {0: "batch"}
+    try:
+        torch.onnx.export(module, args, fp32_path, input_names=input_names, output_names=["embeds"],
+                          dynamic_axes=dynamic_axes, opset_version=17)
+        ort_quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, path)
+    finally:
+        for leftover in (fp32_path, tmp_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+def main():
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    class ImageEncoder(torch.nn.Module):
+        """Обертка над визуальной частью CLIP для экспорта в ONNX"""
+        def __init__(self, clip):
+            super().__init__()
+            self.clip = clip
+
+        def forward(self, pixel_values):
+            return self.clip.get_image_features(pixel_values=pixel_values)
+
+    class TextEncoder(torch.nn.Module):
+        """Обертка над текстовой частью CLIP для экспорта в ONNX"""
+        def __init__(self, clip):
+            super().__init__()
+            self.clip = clip
+
+        def forward(self, input_ids, attention_mask):
+            return self.clip.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+    os.makedirs(ONNX_DIR, exist_ok=True)
+    st_model = SentenceTransformer('clip-ViT-B-32', device='cpu').eval()
+    clip = st_model[0].model
+    processor = st_model[0].processor
+
+    with torch.no_grad():
+        logger.info(f"Экспорт {IMAGE_ONNX_PATH}")
+        export_onnx(ImageEncoder(clip), (torch.zeros(1, 3, 224, 224),), ["pixel_values"], IMAGE_ONNX_PATH)
+        logger.info(f"Экспорт {TEXT_ONNX_PATH}")
+        tokens = processor.tokenizer(["a photo"], return_tensors='pt')
+        export_onnx(TextEncoder(clip), (tokens["input_ids"], tokens["attention_mask"]),
+                    ["input_ids", "attention_mask"], TEXT_ONNX_PATH)
+
+    # Препроцессор сохраняется рядом, чтобы боту не нужно было грузить веса PyTorch
+    processor.save_pretrained(ONNX_DIR)
+    logger.info("Готово")
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import os
-import json
+import asyncio
+import concurrent.futures
+import orjson
 import numpy as np
 from io import BytesIO
 from PIL import Image
@@ -7,12 +9,25 @@ import torch
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
 from sentence_transformers import SentenceTransformer
+from transformers import CLIPProcessor
 import logging
-import gc
+from collections import OrderedDict, Counter
+from export_onnx import ONNX_DIR, IMAGE_ONNX_PATH, TEXT_ONNX_PATH
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
 
 # Отключаем GPU и настраиваем PyTorch для экономии памяти
 os.environ["CUDA_VISIBLE_DEVICES"] = ""
 torch.set_num_threads(1)  # Ограничиваем количество потоков
+torch.set_float32_matmul_precision('medium')  # Разрешаем быстрые bf16/tf32 GEMM там, где они есть
 
 # Настройка логирования
 logging.basicConfig(
@@ -23,57 +38,370 @@ logger = logging.getLogger(__name__)
 
 TOKEN = os.getenv('TOKEN')
 DB_FILE = "wardrobe_db.json"
+EMB_FILE = "wardrobe_emb.npy"  # Файл матрицы до появления поколений
+EMB_FILE_PATTERN = "wardrobe_emb.{}.npy"
 IMG_DIR = "temp_images"
+MAX_BATCH = 8  # Максимальный размер батча для энкодера
+BATCH_TIMEOUT = 0.02  # Сколько ждать остальные запросы в батч, секунды
+ENCODE_TIMEOUT = 60  # Максимальное ожидание эмбеддинга одним обработчиком, секунды
 os.makedirs(IMG_DIR, exist_ok=True)
 
-# Инициализация модели с оптимизацией памяти
-model = None
+def load_onnx_sessions():
+    """Открывает заранее собранные INT8-модели (см. export_onnx.py)"""
+    # Один поток, как и для PyTorch
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = 1
+    options.inter_op_num_threads = 1
+    providers = ["CPUExecutionProvider"]
+    return (ort.InferenceSession(IMAGE_ONNX_PATH, options, providers=providers),
+            ort.InferenceSession(TEXT_ONNX_PATH, options, providers=providers))
+
+# Основной путь инференса - квантизованные ONNX-модели в onnxruntime. Модели собираются
+# заранее (python export_onnx.py), в этом режиме веса PyTorch вообще не загружаются
+MODEL = None
+IMAGE_SESSION = TEXT_SESSION = PROCESSOR = None
+if ort is not None and os.path.exists(IMAGE_ONNX_PATH) and os.path.exists(TEXT_ONNX_PATH):
+    try:
+        IMAGE_SESSION, TEXT_SESSION = load_onnx_sessions()
+        PROCESSOR = CLIPProcessor.from_pretrained(ONNX_DIR)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки ONNX-моделей: {e}")
+        IMAGE_SESSION = TEXT_SESSION = None
+else:
+    logger.warning("ONNX-модели не найдены (нужен python export_onnx.py), используется PyTorch")
+
+if IMAGE_SESSION is None:
+    # Запасной путь: модель загружается один раз при старте процесса и общая для всех обработчиков
+    MODEL = SentenceTransformer('clip-ViT-B-32', device='cpu').eval()
+    for param in MODEL.parameters():
+        param.requires_grad = False
+    # Динамическая INT8-квантизация линейных слоев обоих энкодеров CLIP (LayerNorm/GELU остаются в fp32)
+    MODEL[0].model = torch.ao.quantization.quantize_dynamic(MODEL[0].model, {torch.nn.Linear}, dtype=torch.qint8)
+    # sentence-transformers вызывает башни CLIP напрямую, поэтому компилируем именно их.
+    # Размер батча меняется от 1 до MAX_BATCH, поэтому формы динамические - без перекомпиляции на каждый размер
+    MODEL[0].model.vision_model = torch.compile(MODEL[0].model.vision_model, dynamic=True)
+    MODEL[0].model.text_model = torch.compile(MODEL[0].model.text_model, dynamic=True)
+
+# Каким энкодером считаются новые эмбеддинги. Сохраняется в базе: эмбеддинги разных
+# бэкендов немного отличаются (проверка дрейфа - check_drift.py), а фото заново не перекодировать
+ENCODER_BACKEND = "onnx-int8" if IMAGE_SESSION is not None else "torch-int8"
+LEGACY_ENCODER = "torch-fp32"  # Вещи, сохраненные до квантизации
+
+# Матрица эмбеддингов (N, D) в float32 с нормированными строками; строка i соответствует DB["items"][i].
+# float16 - только формат хранения (item["embedding"] и .npy), поиск всегда идет во float32:
+# арифметика float16 в numpy эмулируется и заметно медленнее
+EMB_MATRIX = np.empty((0, 0), dtype=np.float32)
+# Номер поколения файла матрицы и файл, на который ссылается JSON
+EMB_GENERATION = 0
+EMB_CURRENT_FILE = None
+# Если JSON и матрица на диске не согласованы, база не перезаписывается, чтобы не потерять вещи
+DB_READONLY = False
+READONLY_REPLY = "⚠️ База гардероба на диске повреждена, изменения сейчас не сохраняются. Обратитесь к администратору бота."
+
+def encode_images(imgs):
+    """Эмбеддинги батча изображений через onnxruntime или PyTorch"""
+    if IMAGE_SESSION is None:
+        with torch.inference_mode():
+            return MODEL.encode(imgs, batch_size=MAX_BATCH, convert_to_numpy=True)
+    pixel_values = PROCESSOR(images=imgs, return_tensors='np')["pixel_values"]
+    return IMAGE_SESSION.run(None, {"pixel_values": pixel_values.astype(np.float32)})[0]
+
+def encode_texts(texts):
+    """Эмбеддинги батча текстов через onnxruntime или PyTorch"""
+    if TEXT_SESSION is None:
+        with torch.inference_mode():
+            return MODEL.encode(texts, batch_size=MAX_BATCH, convert_to_numpy=True)
+    tokens = PROCESSOR.tokenizer(texts, padding=True, truncation=True, max_length=77, return_tensors='np')
+    return TEXT_SESSION.run(None, {
+        "input_ids": tokens["input_ids"].astype(np.int64),
+        "attention_mask": tokens["attention_mask"].astype(np.int64),
+    })[0]
+
+def warmup_encoders():
+    """Прогрев PyTorch-пути: torch.compile компилирует модель на первом вызове"""
+    if IMAGE_SESSION is not None:
+        return
+    clip = MODEL[0].model
+    try:
+        # Батч из одного элемента компилируется отдельно, поэтому прогреваем и его, и полный батч
+        for n in (1, MAX_BATCH):
+            encode_images([Image.new('RGB', (224, 224))] * n)
+            encode_texts(["warmup"] * n)
+    except Exception as e:
+        logger.error(f"torch.compile не сработал, работаем без компиляции: {e}")
+        clip.vision_model = getattr(clip.vision_model, "_orig_mod", clip.vision_model)
+        clip.text_model = getattr(clip.text_model, "_orig_mod", clip.text_model)
+
+# Очередь запросов к энкодеру: (тип, данные, future). Создается в post_init внутри event loop
+ENCODE_Q = None
+ENCODE_TASK = None
+ENCODERS = {"image": encode_images, "text": encode_texts}
+# Модель считается в отдельном потоке, чтобы не блокировать event loop; один поток - как и torch.set_num_threads(1)
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+async def encode_worker():
+    """Собирает запросы, пришедшие почти одновременно, в один проход модели"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await ENCODE_Q.get()]
+        deadline = loop.time() + BATCH_TIMEOUT
+        try:
+            while len(batch) < MAX_BATCH:
+                batch.append(await asyncio.wait_for(ENCODE_Q.get(), timeout=max(deadline - loop.time(), 0)))
+        except asyncio.TimeoutError:
+            pass
+        
+        try:
+            for kind, encoder in ENCODERS.items():
+                group = [(payload, future) for k, payload, future in batch if k == kind]
+                if not group:
+                    continue
+                try:
+                    embs = await loop.run_in_executor(EXECUTOR, encoder, [payload for payload, _ in group])
+                    for (_, future), emb in zip(group, embs):
+                        if not future.done():
+                            future.set_result(emb)
+                except Exception as e:
+                    logger.error(f"Ошибка в encode_worker: {e}")
+                    for _, future in group:
+                        if not future.done():
+                            future.set_exception(e)
+        finally:
+            # Ни один запрос батча не должен остаться без ответа (короткий результат, отмена воркера)
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("Энкодер не вернул эмбеддинг"))
+
+async def encode(kind, payload):
+    """Ставит запрос в очередь энкодера и ждет результат"""
+    future = asyncio.get_running_loop().create_future()
+    await ENCODE_Q.put((kind, payload, future))
+    # Таймаут страхует от зависания, если воркер энкодера упал
+    return await asyncio.wait_for(future, timeout=ENCODE_TIMEOUT)
+
+# LRU-кеш нормированных эмбеддингов текстовых запросов
+TEXT_CACHE = OrderedDict()
+TEXT_CACHE_SIZE = 256
+
+async def encode_query(text):
+    """Нормированный эмбеддинг текстового запроса; повторные запросы не идут в энкодер"""
+    q = TEXT_CACHE.get(text)
+    if q is not None:
+        TEXT_CACHE.move_to_end(text)
+        return q
+    q = normalize(await encode("text", text))
+    q.flags.writeable = False
+    TEXT_CACHE[text] = q
+    if len(TEXT_CACHE) > TEXT_CACHE_SIZE:
+        TEXT_CACHE.popitem(last=False)
+    return q
+
+async def start_encode_worker(app):
+    global ENCODE_Q, ENCODE_TASK
+    ENCODE_Q = asyncio.Queue()
+    # app.create_task в post_init не отслеживается PTB, поэтому задачу держим и останавливаем сами
+    ENCODE_TASK = asyncio.get_running_loop().create_task(encode_worker())
+
+def normalize(emb):
+    """Приводит эмбеддинг к единичной длине"""
+    emb = emb.astype(np.float32)
+    return emb / (np.linalg.norm(emb) + 1e-12)
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _dot_scores(E, q):
+        out = np.empty(E.shape[0], dtype=np.float32)
+        for i in prange(E.shape[0]):
+            s = 0.0
+            for j in range(E.shape[1]):
+                s += E[i, j] * q[j]
+            out[i] = s
+        return out
+else:
+    # Запасной вариант без numba
+    def _dot_scores(E, q):
+        return E @ q
+
+def cosine_topk(E, q, k):
+    """Возвращает индексы и сходства k ближайших строк E к нормированному запросу q"""
+    sims = _dot_scores(E, q)
+    k = min(k, len(sims))
+    idx = np.argpartition(-sims, k - 1)[:k]
+    idx = idx[np.argsort(-sims[idx])]
+    return idx, sims[idx]
 
-def load_model():
-    global model
-    if model is None:
-        # Загружаем модель с пониженной точностью для экономии памяти
-        model = SentenceTransformer('clip-ViT-B-32', device='cpu')
-        # Переводим модель в режим eval и half-precision
-        model = model.eval()
-        for param in model.parameters():
-            param.requires_grad = False
-    return model
+def build_matrix(db):
+    """Собирает непрерывную матрицу эмбеддингов из базы (эмбеддинги уже нормированы)"""
+    global EMB_MATRIX
+    items = db.get("items", [])
+    if not items:
+        EMB_MATRIX = np.empty((0, 0), dtype=np.float32)
+        return
+    # Приводим к float32 сразу при склейке, без промежуточной float16-копии
+    EMB_MATRIX = np.vstack([item["embedding"] for item in items], dtype=np.float32)
+
+def append_to_matrix(emb):
+    """Добавляет нормированную строку в матрицу эмбеддингов"""
+    global EMB_MATRIX
+    row = emb.astype(np.float32).reshape(1, -1)
+    EMB_MATRIX = row if EMB_MATRIX.size == 0 else np.concatenate([EMB_MATRIX, row])
 
 def load_db():
+    global EMB_GENERATION, EMB_CURRENT_FILE, DB_READONLY
     try:
         if os.path.exists(DB_FILE):
-            with open(DB_FILE, 'r') as f:
-                db = json.load(f)
-                # Конвертируем эмбеддинги обратно в numpy array при загрузке
-                for item in db.get("items", []):
-                    if "embedding" in item:
-                        item["embedding"] = np.array(item["embedding"], dtype=np.float16)
-                return db
+            with open(DB_FILE, 'rb') as f:
+                db = orjson.loads(f.read())
+            items = db.get("items", [])
+            EMB_GENERATION = db.get("generation", 0)
+            EMB_CURRENT_FILE = db.get("emb_file", EMB_FILE)
+            
+            # Эмбеддинги лежат отдельной матрицей float16 (N, D), строка i соответствует items[i].
+            # Старый формат хранил эмбеддинги списками прямо в JSON - тогда .npy не нужен
+            emb = None
+            if any("embedding" not in item for item in items):
+                if os.path.exists(EMB_CURRENT_FILE):
+                    emb = np.load(EMB_CURRENT_FILE, mmap_mode='r')
+                rows = db.get("rows", len(items))
+                if emb is None or len(emb) != len(items) or rows != len(items):
+                    logger.error(f"Матрица {EMB_CURRENT_FILE} не совпадает с {DB_FILE} "
+                                 f"(вещей: {len(items)}, строк: {None if emb is None else len(emb)}); "
+                                 f"запись базы на диск отключена")
+                    DB_READONLY = True
+                    emb = None
+            
+            for i, item in enumerate(items):
+                if "embedding" in item:
+                    # Старый формат, перенесется в .npy при следующей записи
+                    item["embedding"] = np.array(item["embedding"], dtype=np.float16)
+                    # Старые записи хранились без нормировки - нормируем при загрузке,
+                    # исходная длина сохраняется в "norm"
+                    if "norm" not in item:
+                        item["norm"] = float(np.linalg.norm(item["embedding"].astype(np.float32)))
+                        item["embedding"] = normalize(item["embedding"]).astype(np.float16)
+                elif emb is not None:
+                    item["embedding"] = emb[i]
+            
+            # Строки матрицы должны совпадать с вещами; без эмбеддинга вещи остаются только на диске
+            items = [item for item in items if "embedding" in item]
+            # Раньше одну и ту же вещь можно было добавить дважды - оставляем первую копию
+            seen = set()
+            db["items"] = []
+            for item in items:
+                if item["id"] in seen:
+                    logger.warning(f"Дубликат вещи {item['id']} в базе пропущен")
+                    continue
+                seen.add(item["id"])
+                db["items"].append(item)
+            
+            other = Counter(item.setdefault("encoder", LEGACY_ENCODER) for item in db["items"])
+            other.pop(ENCODER_BACKEND, None)
+            if other:
+                logger.warning(f"Эмбеддинги части вещей получены другим энкодером (сейчас {ENCODER_BACKEND}): "
+                               f"{dict(other)}; сходство для них может немного отличаться")
+            build_matrix(db)
+            return db
     except Exception as e:
         logger.error(f"Ошибка загрузки БД: {e}")
-    return {"items": []}
+        if os.path.exists(DB_FILE):
+            DB_READONLY = True
+    db = {"items": []}
+    build_matrix(db)
+    return db
 
 def save_db(db):
+    global EMB_GENERATION, EMB_CURRENT_FILE
+    if DB_READONLY:
+        logger.error("База на диске повреждена, изменения не сохраняются")
+        return
     try:
-        # Создаем копию без numpy массивов для сериализации
-        db_copy = {"items": []}
-        for item in db.get("items", []):
-            item_copy = item.copy()
-            if "embedding" in item_copy:
-                item_copy["embedding"] = item_copy["embedding"].tolist()
-            db_copy["items"].append(item_copy)
+        # Метаданные пишем в JSON, эмбеддинги - одной матрицей в .npy
+        items = db.get("items", [])
+        if items:
+            emb = np.vstack([item["embedding"] for item in items]).astype(np.float16)
+        else:
+            emb = np.empty((0, 0), dtype=np.float16)
         
-        with open(DB_FILE, 'w') as f:
-            json.dump(db_copy, f, indent=2)
+        # Матрица каждый раз пишется в новый файл: старый может быть открыт через mmap,
+        # а JSON до своей замены продолжает ссылаться на прежнюю согласованную матрицу
+        generation = EMB_GENERATION + 1
+        emb_file = EMB_FILE_PATTERN.format(generation)
+        tmp_file = emb_file + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            np.save(f, emb)
+        os.replace(tmp_file, emb_file)
+        
+        db_copy = {
+            "generation": generation,
+            "emb_file": emb_file,
+            "rows": len(items),
+            "encoder": ENCODER_BACKEND,
+            "items": [{k: v for k, v in item.items() if k != "embedding"} for item in items],
+        }
+        # Компактный JSON через временный файл; его замена и есть момент фиксации записи
+        tmp_file = DB_FILE + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(orjson.dumps(db_copy))
+        os.replace(tmp_file, DB_FILE)
+        
+        old_file = EMB_CURRENT_FILE
+        EMB_GENERATION, EMB_CURRENT_FILE = generation, emb_file
+        if old_file and old_file != emb_file and os.path.exists(old_file):
+            os.remove(old_file)
     except Exception as e:
         logger.error(f"Ошибка сохранения БД: {e}")
 
-async def cleanup_memory():
-    """Очистка памяти"""
-    gc.collect()
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
+# База держится в памяти; изменения сбрасываются на диск с задержкой
+DB = load_db()
+# Индекс id -> позиция в DB["items"] (и строка в EMB_MATRIX)
+ID_INDEX = {item["id"]: i for i, item in enumerate(DB["items"])}
+DB_LOCK = asyncio.Lock()
+DB_DIRTY = False
+FLUSH_DELAY = 0.5  # секунды
+FLUSH_TASK = None
+
+def remove_from_db(item_id):
+    """Удаляет вещь за O(1): последняя вещь переносится на место удаленной"""
+    global EMB_MATRIX
+    idx = ID_INDEX.pop(item_id, None)
+    if idx is None:
+        return False
+    items = DB["items"]
+    last = len(items) - 1
+    if idx != last:
+        items[idx] = items[last]
+        EMB_MATRIX[idx] = EMB_MATRIX[last]
+        ID_INDEX[items[idx]["id"]] = idx
+    items.pop()
+    EMB_MATRIX = EMB_MATRIX[:last]
+    return True
+
+async def debounced_flush():
+    """Записывает базу на диск один раз на серию изменений"""
+    global DB_DIRTY
+    await asyncio.sleep(FLUSH_DELAY)
+    async with DB_LOCK:
+        if DB_DIRTY:
+            save_db(DB)
+            DB_DIRTY = False
+
+def mark_dirty():
+    """Помечает базу измененной и планирует запись на диск"""
+    global DB_DIRTY, FLUSH_TASK
+    DB_DIRTY = True
+    if FLUSH_TASK is None or FLUSH_TASK.done():
+        FLUSH_TASK = asyncio.create_task(debounced_flush())
+
+async def flush_db(app):
+    """Останавливает воркер энкодера и сбрасывает несохраненные изменения при остановке бота"""
+    if ENCODE_TASK is not None:
+        ENCODE_TASK.cancel()
+        try:
+            await ENCODE_TASK
+        except asyncio.CancelledError:
+            pass
+    if DB_DIRTY:
+        save_db(DB)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -92,57 +420,76 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def save_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        # Загружаем модель только при первом использовании
-        model = load_model()
+        # Не подтверждаем изменения, которые не попадут на диск
+        if DB_READONLY:
+            await update.message.reply_text(READONLY_REPLY)
+            return
         
         photo = update.message.photo[-1]  # Берем самое большое фото
-        file = await photo.get_file()
         item_id = str(photo.file_id)
+        # Проверяем дубликат до скачивания и кодирования
+        if item_id in ID_INDEX:
+            await update.message.reply_text("Эта вещь уже есть в гардеробе")
+            return
         
-        # Загружаем фото в память без сохранения на диск
-        image_bytes = await file.download_as_bytearray()
-        img = Image.open(BytesIO(image_bytes)).convert('RGB')
+        file = await photo.get_file()
+        
+        # Загружаем фото в память без сохранения на диск, сразу в BytesIO без промежуточного bytearray
+        image_buffer = BytesIO()
+        await file.download_to_memory(image_buffer)
+        image_buffer.seek(0)
+        img = Image.open(image_buffer)
         
-        # Уменьшаем размер изображения для экономии памяти
-        img = img.resize((224, 224))
+        # Просим libjpeg сразу декодировать уменьшенную копию, затем доводим до 224x224
+        img.draft('RGB', (224, 224))
+        img = img.convert('RGB').resize((224, 224), Image.BICUBIC)
+        # После convert изображение полностью декодировано, исходный JPEG больше не нужен
+        del image_buffer
         
-        # Вычисляем эмбеддинг с отключенным градиентом
-        with torch.no_grad():
-            img_emb = model.encode(img, convert_to_tensor=False)
+        # Вычисляем эмбеддинг
+        img_emb = await encode("image", img)
         
-        # Преобразуем в float16 для экономии памяти
-        img_emb = img_emb.astype(np.float16)
+        # Нормируем один раз при вставке и преобразуем в float16 для экономии памяти
+        img_norm = float(np.linalg.norm(img_emb))
+        img_emb = normalize(img_emb).astype(np.float16)
         
         # Сохраняем в базу данных
-        db = load_db()
-        db["items"].append({
-            "id": item_id,
-            "file_path": f"{IMG_DIR}/{item_id}.jpg",  # Путь, но файл не сохраняем
-            "embedding": img_emb,
-            "type": "clothes"
-        })
-        save_db(db)
+        async with DB_LOCK:
+            # Повторная проверка: то же фото могло добавиться, пока шло кодирование
+            duplicate = item_id in ID_INDEX
+            if not duplicate:
+                ID_INDEX[item_id] = len(DB["items"])
+                DB["items"].append({
+                    "id": item_id,
+                    "file_path": f"{IMG_DIR}/{item_id}.jpg",  # Путь, но файл не сохраняем
+                    "embedding": img_emb,
+                    "norm": img_norm,
+                    "encoder": ENCODER_BACKEND,
+                    "type": "clothes"
+                })
+                append_to_matrix(img_emb)
+                total = len(DB["items"])
+                mark_dirty()
         
-        # Очищаем память
-        del img, img_emb, image_bytes
-        await cleanup_memory()
+        # Освобождаем изображение, не дожидаясь конца обработчика
+        del img, img_emb
         
-        await update.message.reply_text(f"✅ Вещь добавлена! Всего: {len(db['items'])}")
+        if duplicate:
+            await update.message.reply_text("Эта вещь уже есть в гардеробе")
+            return
+        await update.message.reply_text(f"✅ Вещь добавлена! Всего: {total}")
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
         logger.error(f"Ошибка в save_item: {e}")
 
 async def generate_look(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        model = load_model()
-        db = load_db()
-        
-        if not db["items"]:
+        if not DB["items"]:
             await update.message.reply_text("В гардеробе пока нет вещей!")
             return
         
         # Простейшая реализация - случайный выбор
-        items = np.random.choice(db["items"], size=min(3, len(db["items"])), replace=False)
+        items = np.random.choice(DB["items"], size=min(3, len(DB["items"])), replace=False)
         
         response = "👗 *Предлагаемый образ:*\n"
         for i, item in enumerate(items, 1):
@@ -152,22 +499,18 @@ async def generate_look(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
         logger.error(f"Ошибка в generate_look: {e}")
-    finally:
-        await cleanup_memory()
 
 async def random_look(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await generate_look(update, context)
 
 async def show_wardrobe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        db = load_db()
-        
-        if not db["items"]:
+        if not DB["items"]:
             await update.message.reply_text("Ваш гардероб пуст!")
             return
         
         response = "👚 *Ваш гардероб:*\n"
-        for i, item in enumerate(db["items"], 1):
+        for i, item in enumerate(DB["items"], 1):
             response += f"{i}. ID: {item['id']}\n"
         
         await update.message.reply_text(response, parse_mode='Markdown')
@@ -181,14 +524,18 @@ async def remove_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Укажите ID вещи для удаления: /remove ID")
             return
         
+        if DB_READONLY:
+            await update.message.reply_text(READONLY_REPLY)
+            return
+        
         item_id = context.args[0]
-        db = load_db()
         
-        initial_count = len(db["items"])
-        db["items"] = [item for item in db["items"] if item["id"] != item_id]
+        async with DB_LOCK:
+            removed = remove_from_db(item_id)
+            if removed:
+                mark_dirty()
         
-        if len(db["items"]) < initial_count:
-            save_db(db)
+        if removed:
             await update.message.reply_text(f"✅ Вещь {item_id} удалена!")
         else:
             await update.message.reply_text(f"❌ Вещь с ID {item_id} не найдена!")
@@ -203,51 +550,48 @@ async def handle_reference(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Отправьте текстовое описание для поиска")
             return
         
-        model = load_model()
-        db = load_db()
-        
-        if not db["items"]:
+        if not DB["items"]:
             await update.message.reply_text("В гардеробе пока нет вещей!")
             return
         
-        # Кодируем текстовый запрос
-        with torch.no_grad():
-            query_embedding = model.encode(text_query, convert_to_tensor=False)
-        query_embedding = query_embedding.astype(np.float16)
-        
-        # Находим ближайшие вещи
-        similarities = []
-        for item in db["items"]:
-            if "embedding" in item:
-                emb = item["embedding"]
-                sim = np.dot(query_embedding, emb) / (np.linalg.norm(query_embedding) * np.linalg.norm(emb))
-                similarities.append((sim, item))
+        # Кодируем текстовый запрос. Эмбеддинги в базе уже единичные - нормируется
+        # только запрос, и косинусное сходство сводится к скалярному произведению
+        q = await encode_query(text_query)
         
-        # Сортируем по убыванию сходства
-        similarities.sort(reverse=True, key=lambda x: x[0])
-        top_items = [item for (sim, item) in similarities[:3]]
-        
-        if not top_items:
+        if EMB_MATRIX.size == 0:
             await update.message.reply_text("Не найдено подходящих вещей")
             return
         
+        # Частичная выборка top-3 за O(N) вместо полной сортировки
+        idx, sims = cosine_topk(EMB_MATRIX, q, 3)
+        top_items = [(sim, DB["items"][i]) for i, sim in zip(idx, sims)]
+        
         response = f"🔍 *Результаты по запросу '{text_query}':*\n"
-        for i, item in enumerate(top_items, 1):
-            response += f"{i}. Вещь ID: {item['id']} (сходство: {similarities[i-1][0]:.2f})\n"
+        for i, (sim, item) in enumerate(top_items, 1):
+            response += f"{i}. Вещь ID: {item['id']} (сходство: {sim:.2f})\n"
         
         await update.message.reply_text(response, parse_mode='Markdown')
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {str(e)}")
         logger.error(f"Ошибка в handle_reference: {e}")
-    finally:
-        await cleanup_memory()
 
 def main():
     try:
-        # Предварительная загрузка модели
-        load_model()
+        # Прогреваем ядро поиска, чтобы компиляция numba не пришлась на первый запрос.
+        # Запросы из TEXT_CACHE read-only, а numba компилирует под них отдельную сигнатуру
+        warmup_q = np.zeros(1, dtype=np.float32)
+        warmup_q.setflags(write=False)
+        cosine_topk(np.zeros((1, 1), dtype=np.float32), warmup_q, 1)
+        # Компиляция модели тоже до первого запроса пользователя
+        warmup_encoders()
         
-        app = ApplicationBuilder().token(TOKEN).build()
+        # concurrent_updates позволяет нескольким запросам одновременно попасть в батч энкодера;
+        # изменения базы защищены DB_LOCK
+        app = (ApplicationBuilder().token(TOKEN)
+               .concurrent_updates(True)
+               .post_init(start_encode_worker)
+               .post_shutdown(flush_db)
+               .build())
         
         app.add_handler(CommandHandler("start", start))
         app.add_handler(CommandHandler("look", generate_look))